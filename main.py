@@ -1,14 +1,41 @@
 ﻿#!/usr/bin/env python3
 import argparse
-import datetime
+import glob
+import hashlib
 from enum import Enum
 import os
+import random
+import re
+import select
+import shutil
+import signal
+import smtplib
 import subprocess
+import threading
 import time
 import logging
+import logging.handlers
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from email.mime.text import MIMEText
-from typing import Callable, Any, List, Optional, Union
-from dataclasses import dataclass
+from typing import Callable, Any, Dict, List, Optional, Sequence, Tuple, Union
+from dataclasses import dataclass, field
+from functools import cached_property
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 class LogLevel(Enum):
     DEBUG = logging.DEBUG
@@ -20,11 +47,81 @@ class LogLevel(Enum):
 # ----------------------------------------
 # Data Structures
 # ----------------------------------------
+class OutputMatcher:
+    # Finds which of a Task's pattern sets occur in the output in one pass, instead of one substring scan per pattern.
+    # Matching happens on the raw output bytes; patterns are UTF-8 encoded once.
+    RETRY = 1
+    EXPECTED = 2
+
+    def __init__(self, expected_output: Optional[List[str]], retry_output: Optional[List[str]]):
+        kinds: Dict[bytes, int] = {}
+        for patterns, kind in ((expected_output, self.EXPECTED), (retry_output, self.RETRY)):
+            for pattern in patterns or []:
+                key = pattern.encode("utf-8")
+                kinds[key] = kinds.get(key, 0) | kind
+        self.all_kinds = self.RETRY * bool(retry_output) | self.EXPECTED * bool(expected_output)
+        # The empty string is contained in every output.
+        self.always = kinds.pop(b"", 0)
+        self.database = None
+        self.automaton = None
+        self.regexes = []
+        if kinds and hyperscan is not None:
+            # One vectorized scan for all literals; SINGLEMATCH reports each pattern at most once.
+            # literal=True compiles the raw bytes via hs_compile_lit_multi, so no escaping and no regex parsing.
+            patterns = list(kinds)
+            self.database = hyperscan.Database()
+            self.database.compile(
+                expressions=patterns,
+                ids=[kinds[p] for p in patterns],
+                elements=len(patterns),
+                flags=[hyperscan.HS_FLAG_SINGLEMATCH] * len(patterns),
+                literal=True,
+            )
+        elif kinds and ahocorasick is not None:
+            # pyahocorasick is built for str keys; latin-1 maps every byte to one char, so matches stay byte-exact.
+            self.automaton = ahocorasick.Automaton()
+            for pattern, kind in kinds.items():
+                self.automaton.add_word(pattern.decode("latin-1"), kind)
+            self.automaton.make_automaton()
+        else:
+            for kind in (self.RETRY, self.EXPECTED):
+                patterns = [p for p, k in kinds.items() if k & kind]
+                if patterns:
+                    self.regexes.append((re.compile(b"|".join(map(re.escape, patterns))), kind))
+
+    @staticmethod
+    def _on_match(kind: int, start: int, end: int, flags: int, context: List[int]):
+        context[0] |= kind
+
+    def scan(self, output: bytes) -> int:
+        hits = self.always
+        if self.database is not None:
+            found = [hits]
+            self.database.scan(output, match_event_handler=self._on_match, context=found)
+            hits = found[0]
+        elif self.automaton is not None:
+            for _, kind in self.automaton.iter(output.decode("latin-1")):
+                hits |= kind
+                if hits == self.all_kinds:
+                    break
+        else:
+            for regex, kind in self.regexes:
+                if not hits & kind and regex.search(output):
+                    hits |= kind
+        return hits
+
 @dataclass
 class Task:
-    command: List[str]
+    command: Sequence[str]
     expected_output: Optional[List[str]] = None
     retry_output: Optional[List[str]] = None
+    probe_command: Optional[Sequence[str]] = None
+    depends_on: Optional[int] = None
+    inputs: Optional[Sequence[str]] = None
+    unchanged_command: Optional[Sequence[str]] = None
+    runner: Optional[Callable[[], "CommandResult"]] = field(default=None, init=False, repr=False, compare=False)
+    probe_runner: Optional[Callable[[], "CommandResult"]] = field(default=None, init=False, repr=False, compare=False)
+    unchanged_runner: Optional[Callable[[], "CommandResult"]] = field(default=None, init=False, repr=False, compare=False)
     
     def __str__(self):
         cmd_str = " ".join(self.command)
@@ -33,9 +130,56 @@ class Task:
             return f"CMD: '{cmd_str}' [Expects to proceed: {output_str}]"
         return f"CMD: '{cmd_str}' [Expects: Exit Code 0]"
 
+    @cached_property
+    def matcher(self) -> OutputMatcher:
+        # Built on first use, after argument parsing has filled in the output patterns.
+        return OutputMatcher(self.expected_output, self.retry_output)
+
+    def prepare(self, cwd: Optional[str], env: Optional[Dict[str, str]] = None):
+        # Called once after parsing: freezes the commands and builds the runners every cycle and retry reuses.
+        self.command = tuple(self.command)
+        self.runner = run_command(self.command, cwd=cwd, env=env, matcher=self.matcher)
+        if self.probe_command:
+            self.probe_command = tuple(self.probe_command)
+            self.probe_runner = run_command(self.probe_command, cwd=cwd, env=env)
+        if self.unchanged_command:
+            self.unchanged_command = tuple(self.unchanged_command)
+            self.unchanged_runner = run_command(self.unchanged_command, cwd=cwd, env=env, matcher=self.matcher)
+
+@dataclass(slots=True)
+class CommandResult:
+    output: bytes
+    returncode: int
+    hits: int = 0
+
+    @property
+    def stdout(self) -> str:
+        # Only decoded when logged or probed, and only the last OUTPUT_TAIL_BYTES.
+        return self.output[-OUTPUT_TAIL_BYTES:].decode("utf-8", errors="replace")
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    repo_dir: str
+    branch: str
+    remotes: Tuple[str, ...]
+    interval: int
+    fetch_interval: int
+    error_email_recipient: str
+    error_email_sender: str
+    email_enabled: bool
+    smtp_host: str
+    exit_on_max_attempts: bool
+    max_attempts: int
+    base_delay: int
+    max_backoff: int
+    tasks: Tuple[Task, ...]
+
 # ----------------------------------------
 # Custom Argument Parsing
 # ----------------------------------------
+def _parse_bool_env(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).strip().lower() in ("1", "true", "yes", "on")
+
 class StoreTaskAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         tasks = getattr(namespace, 'tasks', [])
@@ -47,7 +191,8 @@ class StoreTaskAction(argparse.Action):
                  raise argparse.ArgumentError(self, "A single command string must be provided for --cmd.")
             command_string = values[0]
             command_list = command_string.split() 
-            tasks.append(Task(command=command_list, expected_output=None, retry_output=None))
+            # Tasks run after the previous one unless --depends-on says otherwise.
+            tasks.append(Task(command=command_list, expected_output=None, retry_output=None, depends_on=len(tasks) - 1 if tasks else None))
         elif option_string == '--output':
             if not tasks:
                 raise argparse.ArgumentError(self, "--output cannot be used before a --cmd")
@@ -56,22 +201,77 @@ class StoreTaskAction(argparse.Action):
             if not isinstance(values, list) or len(values) != 1:
                     raise argparse.ArgumentError(self, "A single retry string must be provided for --retry-output.")
             tasks[-1].retry_output = [values[0]]
+        elif option_string == '--probe':
+            if not isinstance(values, list) or len(values) != 1:
+                    raise argparse.ArgumentError(self, "A single command string must be provided for --probe.")
+            if not tasks:
+                raise argparse.ArgumentError(self, "--probe cannot be used before a --cmd")
+            tasks[-1].probe_command = values[0].split()
+        elif option_string == '--depends-on':
+            if not tasks:
+                raise argparse.ArgumentError(self, "--depends-on cannot be used before a --cmd")
+            if values[0].lower() == "none":
+                tasks[-1].depends_on = None
+            else:
+                try:
+                    index = int(values[0])
+                except ValueError:
+                    raise argparse.ArgumentError(self, f"--depends-on expects a task index or 'none', got '{values[0]}'.")
+                if not 0 <= index < len(tasks) - 1:
+                    raise argparse.ArgumentError(self, f"--depends-on must reference an earlier task (0..{len(tasks) - 2}).")
+                tasks[-1].depends_on = index
             
         setattr(namespace, 'tasks', tasks)
 
+# ----------------------------------------
+# Shutdown Handling
+# ----------------------------------------
+_shutdown = threading.Event()
+# Read end of the signal wakeup pipe, readable once SIGTERM/SIGINT arrived.
+_wakeup_fd: Optional[int] = None
+
+class ShutdownRequested(BaseException):
+    # BaseException so the generic 'except Exception' retry/cycle handlers let it through.
+    pass
+
+def interruptible_sleep(seconds: float):
+    if _shutdown.wait(seconds):
+        raise ShutdownRequested()
+
+def next_deadline(deadline: float, interval: float) -> float:
+    # Fixed-rate schedule on the monotonic clock: work time does not push later runs back. After an overrun the
+    # next run starts right away, without replaying every missed slot.
+    return max(deadline + interval, time.monotonic())
+
+def wait_until(deadline: float) -> bool:
+    return _shutdown.wait(max(0.0, deadline - time.monotonic()))
+
+def install_signal_handlers():
+    # PEP 475 resumes an interrupted poll until its timeout, so the signal also writes to a pipe that blocking waits poll on.
+    global _wakeup_fd
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    os.set_blocking(write_fd, False)
+    signal.set_wakeup_fd(write_fd)
+    _wakeup_fd = read_fd
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: _shutdown.set())
+
 # ----------------------------------------
 # Retry Logic
 # ----------------------------------------
-def retry(func: Callable[[], Any], max_attempts: int, base_delay: int, interval: int, logger: logging.Logger, task: Task) -> Any:
+def retry(func: Callable[[], Any], config: Config, logger: logging.Logger, task: Task) -> Any:
+    max_attempts, base_delay, max_backoff, interval = config.max_attempts, config.base_delay, config.max_backoff, config.interval
     attempts = 0
+    prev_delay = base_delay
     while attempts < max_attempts:
         try:
             output = func()
-            if task.retry_output and [s for s in task.retry_output if s in output.stdout.strip()]:
-                time.sleep(interval)
+            if output.hits & OutputMatcher.RETRY:
+                interruptible_sleep(interval)
                 continue
-            if task.expected_output and not [s for s in task.expected_output if s in output.stdout.strip()]:
-                raise ValueError(f"Output validation failed due to missmatch in contains that was expected: {task.expected_output}\n Output: {output}")
+            if task.expected_output and not output.hits & OutputMatcher.EXPECTED:
+                raise ValueError(f"Output validation failed due to missmatch in contains that was expected: {task.expected_output}\n Output: {output.stdout}")
             if output.returncode != 0:
                 raise ValueError(f"Output return code failed, return code: {output.returncode}")
                                  
@@ -79,54 +279,412 @@ def retry(func: Callable[[], Any], max_attempts: int, base_delay: int, interval:
         
         except Exception as e:
             attempts += 1
-            delay = base_delay ** attempts
-            try_log(logger, f"{task.command} failed (attempt {attempts}/{max_attempts}): {e}", LogLevel.WARNING)
-            time.sleep(delay)
+            # Decorrelated jitter: grows roughly exponentially, but desynchronizes watchers sharing a git server.
+            delay = min(max_backoff, random.uniform(base_delay, prev_delay * 3))
+            prev_delay = delay
+            try_log(logger, f"{task.command} failed (attempt {attempts}/{max_attempts}, next in {delay:.1f}s): {e}", LogLevel.WARNING)
+            interruptible_sleep(delay)
     raise RuntimeError(f"{task.command} failed after {max_attempts} attempts")
 
 
 # ----------------------------------------
 # Generic Command Wrapper
 # ----------------------------------------
-def run_command(command: List[str], cwd: str) -> Callable[[], str]:
+# Only the tail of the output is kept; patterns are matched while streaming, so large build logs never sit in memory.
+OUTPUT_TAIL_LINES = 200
+OUTPUT_TAIL_BYTES = 64 * 1024
+
+def run_command(command: Sequence[str], cwd: Optional[str], env: Optional[Dict[str, str]] = None, matcher: Optional[OutputMatcher] = None) -> Callable[[], CommandResult]:
+    # An absolute executable, close_fds=False (our own fds are non-inheritable anyway) and no cwd let CPython
+    # launch through posix_spawn instead of fork/exec. Commands with a cwd never take that path, so they keep
+    # closing fds inherited from the supervisor.
+    command = (shutil.which(command[0]) or command[0], *command[1:])
     def _command():
-        result = subprocess.run(
+        tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        err_tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        hits = matcher.always if matcher is not None else 0
+        with subprocess.Popen(
             command,
             cwd=cwd,
-            capture_output=True,
-            text=True,
-            check=True, #checks on Exit Code: 0
-        )
-        
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=cwd is not None,
+        ) as process:
+            # stderr is drained alongside, so a chatty build never blocks on a full pipe; only stdout is matched.
+            drain = threading.Thread(target=err_tail.extend, args=(process.stderr,), daemon=True)
+            drain.start()
+            for line in process.stdout:
+                tail.append(line)
+                if matcher is not None and hits != matcher.all_kinds:
+                    hits |= matcher.scan(line)
+            returncode = process.wait()
+            drain.join()
+
+        result = CommandResult(output=b"".join(tail), returncode=returncode, hits=hits)
+        if returncode != 0: #checks on Exit Code: 0
+            stderr = b"".join(err_tail)[-OUTPUT_TAIL_BYTES:].decode("utf-8", errors="replace")
+            raise subprocess.CalledProcessError(returncode, command, output=result.stdout, stderr=stderr)
         return result
     return _command
 
+# ----------------------------------------
+# Change Detection
+# ----------------------------------------
+# Last committed probe result (first output field) per probe command.
+_probe_cache: Dict[Tuple[str, ...], str] = {}
+
+def _first_field(output: str) -> str:
+    fields = output.split(maxsplit=1)
+    return fields[0] if fields else ""
+
+def probe(task: Task) -> Optional[str]:
+    # Returns the new probe result when it differs from the committed one, None when unchanged.
+    result = _first_field(task.probe_runner().stdout)
+    if _probe_cache.get(task.probe_command) == result:
+        return None
+    return result
+
+def commit_probe(task: Task, result: str):
+    _probe_cache[task.probe_command] = result
+
+class RefResolver:
+    # One long-lived 'git cat-file --batch-check' answers ref lookups without forking git each time.
+    def __init__(self, repo_dir: str):
+        self.repo_dir = repo_dir
+        self.process = None
+        self.lock = threading.Lock()
+
+    def resolve(self, ref: str) -> Optional[str]:
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.process = subprocess.Popen(
+                    ["git", "cat-file", "--batch-check"],
+                    cwd=self.repo_dir,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    text=True,
+                    bufsize=1,
+                )
+            try:
+                self.process.stdin.write(f"{ref}\n")
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+                if not line:
+                    # EOF: cat-file died after poll(); that is no answer, not a missing ref.
+                    raise OSError(f"git cat-file exited with {self.process.wait()}")
+            except OSError:
+                self.close()
+                raise
+        # '<oid> <type> <size>' on success, '<ref> missing' or '<ref> ambiguous' otherwise.
+        fields = line.split()
+        return fields[0] if len(fields) == 3 else None
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                # Unflushed input to a dead process.
+                pass
+            self.process.wait()
+            self.process = None
+
+class RefWatcher:
+    def __init__(self, repo_dir: str, remotes: Sequence[str], branch: str, resolver: RefResolver, logger: logging.Logger):
+        self.repo_dir = repo_dir
+        self.git_dir = os.path.join(repo_dir, ".git")
+        self.refs = [f"refs/remotes/{remote}/{branch}" for remote in remotes]
+        self.ref_dirs = [os.path.dirname(os.path.join(self.git_dir, ref)) for ref in self.refs]
+        self.resolver = resolver
+        self.logger = logger
+        # Only ref updates wake the watcher; lock files and fsmonitor--daemon cookies would otherwise self-trigger.
+        self.watched_names = {"FETCH_HEAD", "packed-refs", os.path.basename(branch)}
+        self.watched_dirs = set()
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+            except OSError as e:
+                # EMFILE once fs.inotify.max_user_instances is used up.
+                try_log(logger, f"inotify unavailable ({e}), polling every interval instead.", LogLevel.WARNING)
+        self.last_shas = self._resolve()
+        # A ref HEAD does not contain yet counts as undeployed, so a change that arrived while the watcher was down still runs the chain.
+        self.deployed_shas = [sha if sha is None or self._is_merged(repo_dir, sha) else None for sha in self.last_shas]
+        self._add_watches()
+
+    def _resolve(self) -> List[Optional[str]]:
+        return [self.resolver.resolve(ref) for ref in self.refs]
+
+    @staticmethod
+    def _is_merged(repo_dir: str, sha: str) -> bool:
+        return subprocess.run(["git", "-C", repo_dir, "merge-base", "--is-ancestor", sha, "HEAD"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def pending(self) -> Optional[List[Optional[str]]]:
+        # The SHAs still to deploy, None once the last successful chain covered them.
+        self.last_shas = self._resolve()
+        return self.last_shas if self.last_shas != self.deployed_shas else None
+
+    def mark_deployed(self, shas: List[Optional[str]]):
+        # The chain merges the moving '<remote>/<branch>', so a ref the fetcher moved after the snapshot may already
+        # be in HEAD; it counts as deployed too instead of re-running the chain for it.
+        self.deployed_shas = [
+            new if new is not None and new != old and self._is_merged(self.repo_dir, new) else old
+            for old, new in zip(shas, self._resolve())
+        ]
+
+    def _add_watches(self):
+        if self.inotify is None:
+            return
+        mask = inotify_flags.MODIFY | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+        for path in (self.git_dir, *self.ref_dirs):
+            if path not in self.watched_dirs and os.path.isdir(path):
+                try:
+                    self.inotify.add_watch(path, mask)
+                except OSError as e:
+                    # ENOSPC once fs.inotify.max_user_watches is hit.
+                    try_log(self.logger, f"Watching {path} failed ({e}), polling every interval instead.", LogLevel.WARNING)
+                    self.inotify.close()
+                    self.inotify = None
+                    return
+                self.watched_dirs.add(path)
+
+    def wait(self, timeout: int):
+        if self.inotify is None:
+            _shutdown.wait(timeout)
+        else:
+            fds = [self.inotify] if _wakeup_fd is None else [self.inotify, _wakeup_fd]
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0 and not _shutdown.is_set():
+                readable, _, _ = select.select(fds, [], [], remaining)
+                if self.inotify in readable and any(event.name in self.watched_names for event in self.inotify.read(timeout=0)):
+                    break
+            # A remote's ref directory only appears after its first fetch.
+            self._add_watches()
+
+def check_mirrors(config: Config, shas: List[Optional[str]], logger: logging.Logger):
+    # The default chain fast-forwards every remote into one checkout, which only works while they are mirrors,
+    # i.e. all on one line of history. Diverged remotes would fail every cycle, so they stop the watcher up front.
+    known = [sha for sha in shas if sha is not None]
+    if len(set(known)) < 2:
+        return
+    tips = subprocess.run(["git", "-C", config.repo_dir, "merge-base", "--independent", *known], capture_output=True, text=True, check=True).stdout.split()
+    if len(tips) > 1:
+        try_log(logger, f"Remotes {', '.join(config.remotes)} diverged on {config.branch}, the default chain needs mirrors.", LogLevel.CRITICAL)
+        raise SystemExit(1)
+
+def start_fetcher(fetch_tasks: Dict[str, Task], fetch_interval: int, logger: logging.Logger) -> threading.Thread:
+    # Each changed remote is fetched by its own prebuilt '<remote> <branch>' runner, several of them in parallel.
+    fetch_pool = ThreadPoolExecutor(max_workers=len(fetch_tasks), thread_name_prefix="fetch")
+
+    def _fetch_loop():
+        deadline = time.monotonic()
+        while not _shutdown.is_set():
+            try:
+                changed = {}
+                for remote, fetch_task in fetch_tasks.items():
+                    try:
+                        result = probe(fetch_task)
+                    except Exception as e:
+                        try_log(logger, f"Probing {remote} failed: {e}", LogLevel.WARNING)
+                        continue
+                    if result is not None:
+                        changed[remote] = result
+
+                if len(changed) == 1:
+                    remote, result = next(iter(changed.items()))
+                    try_log(logger, f"Remote changed ({result}), running {fetch_tasks[remote]}", LogLevel.INFO)
+                    fetch_tasks[remote].runner()
+                elif changed:
+                    try_log(logger, f"Remotes changed ({', '.join(changed)}), fetching them in parallel", LogLevel.INFO)
+                    for future in [fetch_pool.submit(fetch_tasks[remote].runner) for remote in changed]:
+                        future.result()
+                for remote, result in changed.items():
+                    commit_probe(fetch_tasks[remote], result)
+            except Exception as e:
+                try_log(logger, f"Fetching {', '.join(fetch_tasks)} failed: {e}", LogLevel.WARNING)
+            deadline = next_deadline(deadline, fetch_interval)
+            wait_until(deadline)
+
+    thread = threading.Thread(target=_fetch_loop, name="fetcher", daemon=True)
+    thread.start()
+    return thread
+
 # ----------------------------------------
 # Logging & Email Helpers
 # ----------------------------------------
-def try_log(logger : logging.Logger, message: str, level: LogLevel):
+class BufferedFileHandler(logging.FileHandler):
+    # Writes into an 8 KiB file buffer; only records at flush_level or above force a write(2) right away.
+    def __init__(self, filename: str, mode: str = "a", buffering: int = 8192, flush_level: int = logging.ERROR):
+        self.buffering = buffering
+        self.flush_level = flush_level
+        super().__init__(filename, mode)
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=self.buffering, encoding=self.encoding, errors=self.errors)
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= self.flush_level:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+_TS_FMT = "%Y-%m-%d %H:%M:%S"
+
+_LEVEL_FN = {
+    LogLevel.DEBUG: logging.Logger.debug,
+    LogLevel.INFO: logging.Logger.info,
+    LogLevel.WARNING: logging.Logger.warning,
+    LogLevel.ERROR: logging.Logger.error,
+    LogLevel.CRITICAL: logging.Logger.critical,
+}
+
+def _log_notset(logger: logging.Logger, message: str):
+    logger.log(logging.NOTSET, message)
+
+def try_log(logger : logging.Logger, message: Union[str, Callable[[], str]], level: LogLevel):
     try:
-        match level:
-            case LogLevel.DEBUG: logger.debug(message)
-            case LogLevel.INFO: logger.info(message)
-            case LogLevel.WARNING: logger.warning(message)
-            case LogLevel.ERROR: logger.error(message)
-            case LogLevel.CRITICAL: logger.critical(message)
-            case _: logger.log(logging.NOTSET, message)
+        if callable(message):
+            # Lazy messages are only rendered when the level is enabled.
+            if not logger.isEnabledFor(level.value):
+                return
+            message = message()
+        _LEVEL_FN.get(level, _log_notset)(logger, message)
     except Exception as e:
-        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {message}")
+        print(f"{time.strftime(_TS_FMT)} {message}")
+
+# Rendered headers per (subject, sender, recipient); a mail is just these bytes plus the UTF-8 body.
+_email_headers: Dict[Tuple[str, str, str], bytes] = {}
+_smtp: Optional[smtplib.SMTP] = None
 
-def send_email(error_msg: str, subject: str, email_recipient: str, email_sender: str, logger: logging.Logger):
+def _email_header(subject: str, config: Config) -> bytes:
+    key = (subject, config.error_email_sender, config.error_email_recipient)
+    header = _email_headers.get(key)
+    if header is None:
+        template = MIMEText("", "plain", "utf-8")
+        del template["Content-Transfer-Encoding"]
+        template["Content-Transfer-Encoding"] = "8bit"
+        template["Subject"] = subject
+        template["From"] = config.error_email_sender
+        template["To"] = config.error_email_recipient
+        header = _email_headers[key] = template.as_bytes()
+    return header
+
+def _smtp_connection(host: str) -> smtplib.SMTP:
+    # Reuses one connection across failure bursts, reconnecting when the server dropped it.
+    global _smtp
+    if _smtp is not None:
+        try:
+            if _smtp.noop()[0] == 250:
+                return _smtp
+        except (smtplib.SMTPException, OSError):
+            pass
+        try:
+            _smtp.close()
+        except Exception:
+            pass
+    _smtp = smtplib.SMTP(host, timeout=30)
+    return _smtp
+
+def send_email(error_msg: str, subject: str, config: Config, logger: logging.Logger):
     try:
-        msg = MIMEText(error_msg)
-        msg["Subject"] = subject
-        msg["From"] = email_sender
-        msg["To"] = email_recipient
-        with subprocess.Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=subprocess.PIPE) as p:
-            p.communicate(msg.as_string().encode("utf-8"))
+        message = _email_header(subject, config) + error_msg.encode("utf-8")
+        if config.smtp_host:
+            # The To header may list several comma-separated addresses, RCPT TO takes them one by one.
+            recipients = [address.strip() for address in config.error_email_recipient.split(",") if address.strip()]
+            smtp = _smtp_connection(config.smtp_host)
+            smtp.sendmail(config.error_email_sender, recipients, re.sub(rb"\r?\n", b"\r\n", message))
+        else:
+            with subprocess.Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=subprocess.PIPE) as p:
+                p.communicate(message)
     except Exception as e:
         try_log(logger, f"Failed to send email: {e}", LogLevel.ERROR)
 
+# ----------------------------------------
+# Command Chain
+# ----------------------------------------
+# Files that decide whether images must be rebuilt; a Task with these inputs runs its unchanged_command while they hash the same.
+BUILD_INPUTS = ("**/Dockerfile*", "**/*compose*.yml", "**/*compose*.yaml", "**/.dockerignore")
+
+def _hash_file(digest: "hashlib.blake2b", name: str, full_path: str):
+    if not os.path.isfile(full_path):
+        return
+    digest.update(name.encode("utf-8") + b"\0")
+    with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(b"\0")
+
+def hash_inputs(repo_dir: str, patterns: Sequence[str]) -> str:
+    # Content hash rather than mtimes, so checkouts and 'touch' do not force a rebuild.
+    digest = hashlib.blake2b()
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern, root_dir=repo_dir, recursive=True)})
+    for path in paths:
+        _hash_file(digest, path, os.path.join(repo_dir, path))
+    return digest.hexdigest()
+
+def _build_hash_path(repo_dir: str) -> str:
+    # Kept inside .git when possible, so the sentinel never shows up in the deployed working tree.
+    git_dir = os.path.join(repo_dir, ".git")
+    return os.path.join(git_dir if os.path.isdir(git_dir) else repo_dir, ".last_build_hash")
+
+def read_build_hash(repo_dir: str) -> Optional[str]:
+    try:
+        with open(_build_hash_path(repo_dir), encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def write_build_hash(repo_dir: str, digest: str):
+    with open(_build_hash_path(repo_dir), "w", encoding="utf-8") as f:
+        f.write(digest)
+
+def run_chain(config: Config, executor: ThreadPoolExecutor, logger: logging.Logger):
+    repo_dir = config.repo_dir
+    probed = []
+    futures = []
+
+    def _run_task(task: Task) -> bool:
+        # A failed dependency re-raises here, a skipped one (unchanged probe) skips its dependents.
+        if task.depends_on is not None and not futures[task.depends_on].result():
+            return False
+        if task.probe_command:
+            result = probe(task)
+            if result is None:
+                try_log(logger, lambda: f"Skipping {task} and its dependents, probe unchanged.", LogLevel.DEBUG)
+                return False
+            probed.append((task, result))
+        runner = task.runner
+        digest = None
+        if task.inputs:
+            try:
+                digest = hash_inputs(repo_dir, task.inputs)
+            except OSError as e:
+                # Without a hash the full command runs, a stale image is worse than a slow build.
+                try_log(logger, f"Hashing build inputs failed, building: {e}", LogLevel.WARNING)
+            if digest is not None and digest == read_build_hash(repo_dir):
+                try_log(logger, f"Build inputs unchanged, running '{' '.join(task.unchanged_command)}' instead.", LogLevel.INFO)
+                runner = task.unchanged_runner
+                digest = None
+        retry(runner, config, logger, task)
+        if digest is not None:
+            write_build_hash(repo_dir, digest)
+        return True
+
+    for task in config.tasks:
+        futures.append(executor.submit(_run_task, task))
+    wait(futures)
+    for future in futures:
+        future.result()
+
+    # Probe results only count once the chain went through, so a failed deploy is picked up again.
+    for task, result in probed:
+        commit_probe(task, result)
+
 # ----------------------------------------
 # Main Loop
 # ----------------------------------------
@@ -135,75 +693,172 @@ def main():
     
     # Config
     parser.add_argument("--repo-dir", default=os.getenv("REPO_DIR", "./app"))
+    parser.add_argument("--branch", default=os.getenv("BRANCH", "main"))
+    parser.add_argument("--remote", nargs="+", default=os.getenv("REMOTE", "origin").split())
     parser.add_argument("--interval", type=int, default=int(os.getenv("INTERVAL", "60")))
+    parser.add_argument("--fetch-interval", type=int, default=int(os.getenv("FETCH_INTERVAL", "300")))
     parser.add_argument("--log-file", default=os.getenv("LOG_FILE", "error.log"))
     parser.add_argument("--error-email-recipient", default=os.getenv("ERROR_EMAIL_RECIPIENT", ""))
     parser.add_argument("--error-email-sender", default=os.getenv("ERROR_EMAIL_SENDER", ""))
-    parser.add_argument("--exit-on-max-attempts", action="store_true", default=os.getenv("EXIT_ON_MAX_ATTEMPTS", "false").lower() in ("1","true","yes"))
+    parser.add_argument("--smtp-host", default=os.getenv("SMTP_HOST", ""))
+    parser.add_argument("--exit-on-max-attempts", action="store_true", default=_parse_bool_env("EXIT_ON_MAX_ATTEMPTS", False))
     parser.add_argument("--max-attempts", type=int, default=int(os.getenv("MAX_ATTEMPTS", "5")))
     parser.add_argument("--base-delay", type=int, default=int(os.getenv("BASE_DELAY", "2")))
+    parser.add_argument("--max-backoff", type=int, default=int(os.getenv("MAX_BACKOFF", "60")))
+    parser.add_argument("--skip-unchanged-build", action="store_true", default=_parse_bool_env("SKIP_UNCHANGED_BUILD", False))
     
     # Commands
     parser.add_argument("--cmd", nargs=1, action=StoreTaskAction, dest='tasks', help="Command to execute (as a single quoted string).")
-    parser.add_argument("--output", nargs='+', action=StoreTaskAction, dest='tasks', help="List of validation strings. Used as 'success validation'.")
-    parser.add_argument("--retry-output", nargs=1, action=StoreTaskAction, dest='tasks', help="Retry condition on Command output.")
+    parser.add_argument("--output", nargs='+', action=StoreTaskAction, dest='tasks', help="List of validation strings. Used as 'success validation'. Matched per stdout line, so a string cannot span lines.")
+    parser.add_argument("--retry-output", nargs=1, action=StoreTaskAction, dest='tasks', help="Retry condition on Command output. Matched per stdout line, so a string cannot span lines.")
+    parser.add_argument("--depends-on", nargs=1, action=StoreTaskAction, dest='tasks', help="Index of the task this Command waits for, or 'none' to run it in parallel. Defaults to the previous task.")
+    parser.add_argument("--probe", nargs=1, action=StoreTaskAction, dest='tasks', help="Cheap command run before the Command; the chain stops while its output is unchanged.")
     
     args = parser.parse_args() 
+    args.remote = [remote for value in args.remote for remote in value.split(",") if remote]
 
     # Logging Setup
+    log_format = logging.Formatter("%(asctime)s %(levelname)s: %(message)s")
     handlers = [logging.StreamHandler()]
     try:
         log_dir = os.path.dirname(args.log_file)
         if log_dir and not os.path.exists(log_dir):
             os.makedirs(log_dir)
-        handlers.append(logging.FileHandler(args.log_file, mode="a"))
+        file_handler = BufferedFileHandler(args.log_file, mode="a")
+        file_handler.setFormatter(log_format)
+        # File records are batched; errors flush the batch immediately.
+        handlers.append(logging.handlers.MemoryHandler(capacity=64, flushLevel=logging.ERROR, target=file_handler))
     except Exception as e:
         print(f"⚠️ Failed to create file handler: {e}")
         return
     
     logger = logging.getLogger(__name__)
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s", handlers=handlers)
+    for handler in handlers:
+        handler.setFormatter(log_format)
+    logging.basicConfig(level=logging.INFO, handlers=handlers)
 
-    if not hasattr(args, 'tasks') or not args.tasks:
+    default_chain = not getattr(args, 'tasks', None)
+    if default_chain:
         try_log(logger, "No arguments provided, using default command chain.", LogLevel.INFO)
+        # Merges share one working tree, so they stay sequential.
         args.tasks = [
-            Task(command=["git pull origin main"], expected_output=["files changed"], retry_output=["Already up to date."]),
-            Task(command=["docker compose build"], expected_output=None),
-            Task(command=["docker compose --profile prod up -d"], expected_output=[''])
+            Task(command=["git", "merge", "--ff-only", f"{remote}/{args.branch}"], expected_output=None, depends_on=i - 1 if i else None)
+            for i, remote in enumerate(args.remote)
         ]
+        compose_task = Task(command=["docker", "compose", "--profile", "prod", "up", "--build", "-d", "--remove-orphans"], expected_output=[''], depends_on=len(args.tasks) - 1)
+        if args.skip_unchanged_build:
+            compose_task.inputs = BUILD_INPUTS
+            compose_task.unchanged_command = ["docker", "compose", "--profile", "prod", "up", "-d", "--remove-orphans"]
+        args.tasks.append(compose_task)
+
+    for task in args.tasks:
+        task.prepare(cwd=args.repo_dir)
+
+    # Invariants are resolved once; the loop below only reads slot attributes of the frozen Config.
+    config = Config(
+        repo_dir=args.repo_dir,
+        branch=args.branch,
+        remotes=tuple(args.remote),
+        interval=args.interval,
+        fetch_interval=args.fetch_interval,
+        error_email_recipient=args.error_email_recipient,
+        error_email_sender=args.error_email_sender or "error@localhost",
+        email_enabled=bool(args.error_email_recipient),
+        smtp_host=args.smtp_host,
+        exit_on_max_attempts=args.exit_on_max_attempts,
+        max_attempts=args.max_attempts,
+        base_delay=args.base_delay,
+        max_backoff=args.max_backoff,
+        tasks=tuple(args.tasks)
+    )
+
+    # Event-driven refresh: a background fetch updates the remote ref, the chain only runs once it moved.
+    # The fetch itself only happens when 'git ls-remote' reports a SHA other than the local remote-tracking ref.
+    watcher = None
+    resolver = None
+    if os.path.isdir(os.path.join(config.repo_dir, ".git")):
+        # The fetch never needs the index, so optional locks are skipped to not contend with the deploy chain.
+        # Its commands carry 'git -C <repo>', so they run without cwd and stay on the posix_spawn path.
+        fetch_env = {**os.environ, "GIT_OPTIONAL_LOCKS": "0"}
+        fetch_tasks = {}
+        for remote in config.remotes:
+            fetch_tasks[remote] = Task(
+                command=["git", "-C", config.repo_dir, "fetch", "--no-tags", remote, config.branch],
+                probe_command=["git", "-C", config.repo_dir, "ls-remote", remote, f"refs/heads/{config.branch}"]
+            )
+            fetch_tasks[remote].prepare(cwd=None, env=fetch_env)
+        resolver = RefResolver(config.repo_dir)
+        watcher = RefWatcher(config.repo_dir, config.remotes, config.branch, resolver, logger)
+        for fetch_task, sha in zip(fetch_tasks.values(), watcher.last_shas):
+            if sha is not None:
+                commit_probe(fetch_task, sha)
+        if default_chain:
+            check_mirrors(config, watcher.last_shas, logger)
+        start_fetcher(fetch_tasks, config.fetch_interval, logger)
+    else:
+        try_log(logger, f"{config.repo_dir} is not a git repository, falling back to polling every {config.interval}s.", LogLevel.WARNING)
 
+    install_signal_handlers()
+
+    # One worker per task, so a task blocking on its dependency never starves the pool.
+    executor = ThreadPoolExecutor(max_workers=len(config.tasks), thread_name_prefix="task")
+    # Loop invariants bound to locals once.
+    interval, max_attempts = config.interval, config.max_attempts
+    email_enabled, exit_on_max_attempts = config.email_enabled, config.exit_on_max_attempts
     consecutive_failures = 0
+    deadline = time.monotonic()
 
-    while True:
+    while not _shutdown.is_set():
+        failed = False
         try:
+            # A resolver failure counts as a failed cycle instead of ending the loop.
+            if watcher is not None:
+                shas = watcher.pending()
+                if shas is None:
+                    watcher.wait(interval)
+                    continue
+
             # ---------------------------------------------------------
-            # Logic: Consecutively Run Command Chain.
+            # Logic: Run Command Chain, dependent Tasks in order, independent ones in parallel.
             # ---------------------------------------------------------
-            for i, task in enumerate(args.tasks):
-                retry(
-                    run_command(task.command, cwd=args.repo_dir),
-                    max_attempts=args.max_attempts, base_delay=args.base_delay, interval=args.interval, logger=logger, task=task
-                )
+            run_chain(config, executor, logger)
 
             consecutive_failures = 0 
+            if watcher is not None:
+                watcher.mark_deployed(shas)
+
+        except ShutdownRequested:
+            break
 
         except RuntimeError as e_runtimError:
             try_log(logger, f"RuntimError: {e_runtimError}", LogLevel.ERROR)
-            if bool(args.error_email_recipient):
-                send_email(f"Error: {e_runtimError}", "Command Chain Failed", args.error_email_recipient, args.error_email_sender, logger)
+            if email_enabled:
+                send_email(f"Error: {e_runtimError}", "Command Chain Failed", config, logger)
             raise RuntimeError(e_runtimError)
         
         except Exception as e:
+            failed = True
             consecutive_failures += 1
-            try_log(logger, f"Cycle failed ({consecutive_failures}/{args.max_attempts}): {e}", LogLevel.ERROR)
+            try_log(logger, f"Cycle failed ({consecutive_failures}/{max_attempts}): {e}", LogLevel.ERROR)
             
-            if consecutive_failures >= args.max_attempts:
-                if bool(args.error_email_recipient):
-                    send_email(f"Error: {e}", "Command Chain Failed", args.error_email_recipient, args.error_email_sender, logger)
-                if args.exit_on_max_attempts:
-                    raise RuntimeError("Max attempts reached.")
+            if consecutive_failures >= max_attempts:
+                if email_enabled:
+                    send_email(f"Error: {e}", "Command Chain Failed", config, logger)
+                if exit_on_max_attempts:
+                    try_log(logger, "Max attempts reached, exiting.", LogLevel.CRITICAL)
+                    raise SystemExit(1)
+
+        if watcher is None:
+            deadline = next_deadline(deadline, interval)
+            wait_until(deadline)
+        elif failed:
+            # The refs stay pending and are retried after the next wait.
+            watcher.wait(interval)
 
-        time.sleep(args.interval)
+    executor.shutdown()
+    if resolver is not None:
+        resolver.close()
+    try_log(logger, "Shutdown requested, stopping.", LogLevel.INFO)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file